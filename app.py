@@ -4,27 +4,328 @@ Main application file with all routes and endpoints
 """
 
 import os
+import json
+import logging
+import shutil
+import stat
+import tempfile
+import threading
+import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from flask import Flask, render_template, request, jsonify, send_file
 from werkzeug.utils import secure_filename
 from utils.image_processor import (
     allowed_file, 
+    get_pillow_build_info,
     image_to_base64, 
+    encoded_to_base64,
     get_image_info,
     adjust_brightness,
+    load_rgb_array,
+    PREVIEW_MAX,
+    render_adjustments,
     compress_image,
     crop_image,
+    save_encoded_image,
     save_image
 )
+from utils import gpu_backend, image_cache
 from PIL import Image
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
+# Intermediate edits live here (RAM-backed tmpfs where available) and are only
+# copied to UPLOAD_FOLDER on download or compress
+# (per-user name on Unix, where the parent is shared with other accounts)
+app.config['TMP_FOLDER'] = os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+    f"img_editor-{os.getuid()}" if hasattr(os, 'getuid') else 'img_editor'
+)
+# Intermediate edits untouched for this long (seconds) belong to abandoned
+# sessions and are deleted
+app.config['TMP_MAX_AGE'] = 24 * 60 * 60
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10MB max file size
+# Render slider previews on a CUDA GPU (needs torch + torchvision)
+app.config['USE_GPU'] = os.environ.get('USE_GPU', '').lower() in ('1', 'true')
+# Behind nginx/Apache, let the proxy stream downloads straight from disk
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true')
+
+# Worker processes for CPU-bound compression, shared across requests
+compress_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+compress_pool_lock = threading.Lock()
+
+
+def create_private_folder(path):
+    """
+    Create a directory only the current user can access, or reuse it
+    
+    The temp folder sits in a world-writable parent, so another local user
+    could create it first (or plant a symlink) to read or swap our files.
+    An existing directory is only reused if it is ours and private; otherwise
+    a fresh, randomly named one is created next to it.
+    
+    Args:
+        path (str): Preferred directory path
+    
+    Returns:
+        str: Path of the private directory
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    
+    # Windows has no uids or POSIX modes; the per-user temp dir is private already
+    if not hasattr(os, 'getuid'):
+        return path
+    
+    st = os.lstat(path)
+    if stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077:
+        return path
+    
+    app.logger.warning(f"{path} is not a private directory owned by this user; not using it")
+    return tempfile.mkdtemp(prefix=f"{os.path.basename(path)}-", dir=os.path.dirname(path))
 
-# Ensure upload folder exists
+
+def remove_stale_tmp_files():
+    """
+    Delete intermediate edits of sessions abandoned for over TMP_MAX_AGE
+    
+    Their last persisted copy in UPLOAD_FOLDER is kept. This is housekeeping,
+    so failures are logged rather than raised.
+    """
+    cutoff = time.time() - app.config['TMP_MAX_AGE']
+    try:
+        with os.scandir(app.config['TMP_FOLDER']) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    # Removed by reset or a concurrent sweep
+                    pass
+    except FileNotFoundError:
+        # Something cleaned out the temp folder's parent (e.g. systemd-logind's
+        # RemoveIPC on /dev/shm); recreate it so edits can be saved again
+        app.logger.warning(f"{app.config['TMP_FOLDER']} disappeared; recreating it")
+        app.config['TMP_FOLDER'] = create_private_folder(app.config['TMP_FOLDER'])
+    except OSError as e:
+        app.logger.warning(f"Could not clean up {app.config['TMP_FOLDER']}: {e}")
+
+
+# Files we create should get the same mode as file.save() would give them
+current_umask = os.umask(0)
+os.umask(current_umask)
+
+# Ensure upload and temp folders exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+app.config['TMP_FOLDER'] = create_private_folder(app.config['TMP_FOLDER'])
+remove_stale_tmp_files()
+
+# Report the Pillow build so deploys don't silently fall back to scalar code.
+# Flask's logger only shows warnings until app.run(debug=True) changes that,
+# so lower it now or the SIMD confirmation below is never printed.
+if app.logger.getEffectiveLevel() > logging.INFO:
+    app.logger.setLevel(logging.INFO)
+pillow_info = get_pillow_build_info()
+if pillow_info['simd']:
+    app.logger.info(f"Using Pillow-SIMD {pillow_info['version']}")
+else:
+    app.logger.warning(
+        f"Using stock Pillow {pillow_info['version']}; "
+        "install pillow-simd for vectorized ImageEnhance/filter kernels"
+    )
+if not pillow_info['libjpeg_turbo']:
+    app.logger.warning(
+        "Pillow is not linked against libjpeg-turbo; JPEG encode/decode will be slower"
+    )
+if app.config['USE_GPU'] and not gpu_backend.is_available():
+    app.logger.warning("USE_GPU is set but torch/CUDA is unavailable; previews will render on the CPU")
+
+
+def get_pending_path(filename):
+    """
+    Path of the file holding adjustments previewed but not yet applied
+    
+    Args:
+        filename (str): Name of the working file
+    """
+    return os.path.join(app.config['TMP_FOLDER'], f"pending_{filename}.json")
+
+
+def get_tmp_path(filename):
+    """
+    Path of the intermediate working copy in TMP_FOLDER
+    
+    Args:
+        filename (str): Name of the working file
+    """
+    return os.path.join(app.config['TMP_FOLDER'], filename)
+
+
+def get_working_path(filename):
+    """
+    Path of the newest working copy: the intermediate one if there have been
+    edits since the last download/compress, otherwise the one in UPLOAD_FOLDER
+    
+    Args:
+        filename (str): Name of the working file
+    """
+    tmp_filepath = get_tmp_path(filename)
+    if os.path.exists(tmp_filepath):
+        return tmp_filepath
+    return os.path.join(app.config['UPLOAD_FOLDER'], filename)
+
+
+def save_working_copy(image, filename):
+    """
+    Write the intermediate working copy in TMP_FOLDER
+    
+    The image is saved under a unique name and renamed over the old copy, so
+    a concurrent reader of get_working_path() opens one complete file or the
+    other, never a missing or half-written one.
+    
+    Args:
+        image (PIL.Image): Image to save
+        filename (str): Name of the working file
+    
+    Returns:
+        int: Size of the saved file in bytes
+    """
+    fd, staging_filepath = tempfile.mkstemp(
+        dir=app.config['TMP_FOLDER'], prefix=f"{filename}.", suffix='.tmp'
+    )
+    os.close(fd)
+    try:
+        save_image(image, staging_filepath)
+        size_bytes = os.path.getsize(staging_filepath)
+        os.replace(staging_filepath, get_tmp_path(filename))
+    except Exception:
+        # save_image may have unlinked the file before failing
+        if os.path.exists(staging_filepath):
+            os.remove(staging_filepath)
+        raise
+    
+    return size_bytes
+
+
+def promote_working_copy(filename):
+    """
+    Copy the intermediate working copy into UPLOAD_FOLDER
+    
+    The copy is staged under a unique name next to its destination (TMP_FOLDER
+    is usually a different filesystem) and renamed over it, so concurrent
+    downloads each publish a complete file. The intermediate copy stays where
+    it is: moving it away would leave a moment where neither folder holds the
+    latest edit, and a concurrent edit or download would pick up the old one.
+    
+    Args:
+        filename (str): Name of the working file
+    """
+    tmp_filepath = get_tmp_path(filename)
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    
+    fd, staging_filepath = tempfile.mkstemp(
+        dir=app.config['UPLOAD_FOLDER'], prefix=f".{filename}.", suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            with open(tmp_filepath, 'rb') as src:
+                shutil.copyfileobj(src, dst)
+        # mkstemp() creates the file private; give it the usual upload mode
+        os.chmod(staging_filepath, 0o666 & ~current_umask)
+        os.replace(staging_filepath, filepath)
+    except FileNotFoundError:
+        # No edits since the last download/compress (or reset removed them)
+        os.remove(staging_filepath)
+    except Exception:
+        os.remove(staging_filepath)
+        raise
+
+
+def write_pending_adjustments(filename, adjustments):
+    """
+    Record adjustments previewed but not yet applied
+    
+    Slider requests can overlap, so the file is written under a unique name
+    and renamed into place; readers see either the old or the new file, never
+    a mix of both.
+    
+    Args:
+        filename (str): Name of the working file
+        adjustments (dict): Keyword arguments for render_adjustments()
+    """
+    fd, staging_filepath = tempfile.mkstemp(
+        dir=app.config['TMP_FOLDER'], prefix=f"pending_{filename}.", suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(adjustments, f)
+        os.replace(staging_filepath, get_pending_path(filename))
+    except Exception:
+        os.remove(staging_filepath)
+        raise
+
+
+def run_compress_job(*args, **kwargs):
+    """
+    Run compress_image in the worker pool and wait for its result
+    
+    A worker that dies mid-job (e.g. OOM-killed decoding a huge upload) breaks
+    the whole executor, so the pool is replaced and the job retried once.
+    
+    Raises:
+        BrokenProcessPool: If the job's worker died on the retry as well
+    """
+    global compress_pool
+    
+    for attempt in range(2):
+        pool = compress_pool
+        try:
+            return pool.submit(compress_image, *args, **kwargs).result()
+        except BrokenProcessPool:
+            # Concurrent requests see the same broken pool; only one replaces it
+            with compress_pool_lock:
+                if compress_pool is pool:
+                    compress_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+                    pool.shutdown(wait=False)
+            if attempt:
+                raise
+
+
+def apply_pending_adjustments(filename):
+    """
+    Write previewed adjustments to the working copy at full resolution
+    
+    /preview-adjustments only renders a reduced-resolution preview. Every
+    route that reads the working copy calls this first so it sees the result.
+    
+    Args:
+        filename (str): Name of the working file
+    """
+    # Claim the pending file by renaming it, so concurrent callers can't both
+    # apply (or both remove) it; whoever loses the race has nothing to do
+    pending_filepath = get_pending_path(filename)
+    claimed_filepath = f"{pending_filepath}.{uuid.uuid4().hex}"
+    try:
+        os.replace(pending_filepath, claimed_filepath)
+    except FileNotFoundError:
+        return
+    
+    try:
+        with open(claimed_filepath) as f:
+            adjustments = json.load(f)
+    finally:
+        os.remove(claimed_filepath)
+    
+    original_filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"original_{filename}")
+    arr, _, _ = load_rgb_array(original_filepath)
+    img = render_adjustments(arr, **adjustments)
+    
+    save_working_copy(img, filename)
 
 
 @app.route('/')
@@ -58,21 +359,29 @@ def upload_image():
         
         # Generate unique filename
         original_filename = secure_filename(file.filename)
-        file_ext = original_filename.rsplit('.', 1)[1].lower()
+        file_ext = original_filename.rpartition('.')[2].lower()
         unique_filename = f"{uuid.uuid4()}.{file_ext}"
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
         
         # Save file
         file.save(filepath)
         
-        # Also save as "original" for real-time adjustments
+        # Uploads start new sessions; a good time to clean up after old ones
+        remove_stale_tmp_files()
+        
+        # Also keep an "original" for real-time adjustments. Hardlink it to the
+        # saved upload instead of writing the body twice (save_image unlinks
+        # before overwriting, so edits never reach the original)
         original_filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"original_{unique_filename}")
-        file.seek(0)  # Reset file pointer
-        file.save(original_filepath)
+        try:
+            os.link(filepath, original_filepath)
+        except OSError:
+            # Filesystem without hardlink support
+            shutil.copyfile(filepath, original_filepath)
         
         # Open image and get info
         img = Image.open(filepath)
-        img_info = get_image_info(img)
+        img_info = get_image_info(img, size_bytes=os.path.getsize(filepath))
         
         # Convert to base64 for preview
         preview = image_to_base64(img)
@@ -115,53 +424,43 @@ def preview_adjustments():
         if not os.path.exists(original_filepath):
             return jsonify({'error': 'Original file not found'}), 404
         
-        # Open original image
-        img = Image.open(original_filepath)
-        
-        # Convert to RGB if needed
-        if img.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-            img = background
-        
-        # Apply adjustments from PIL ImageEnhance
-        from PIL import ImageEnhance
-        
-        # Brightness
-        brightness = float(data.get('brightness', 1.0))
-        if brightness != 1.0:
-            enhancer = ImageEnhance.Brightness(img)
-            img = enhancer.enhance(brightness)
-        
-        # Contrast
-        contrast = float(data.get('contrast', 1.0))
-        if contrast != 1.0:
-            enhancer = ImageEnhance.Contrast(img)
-            img = enhancer.enhance(contrast)
-        
-        # Saturation (Color)
-        saturation = float(data.get('saturation', 1.0))
-        if saturation != 1.0:
-            enhancer = ImageEnhance.Color(img)
-            img = enhancer.enhance(saturation)
-        
-        # Sharpness
-        sharpness = float(data.get('sharpness', 1.0))
-        if sharpness != 1.0:
-            enhancer = ImageEnhance.Sharpness(img)
-            img = enhancer.enhance(sharpness)
-        
-        # Get updated info
-        img_info = get_image_info(img)
+        adjustments = {
+            'brightness': float(data.get('brightness', 1.0)),
+            'contrast': float(data.get('contrast', 1.0)),
+            'saturation': float(data.get('saturation', 1.0)),
+            'sharpness': float(data.get('sharpness', 1.0))
+        }
         
-        # Save adjusted image (overwrite working copy)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        save_image(img, filepath)
+        # Render at preview resolution from the cached, reduced-scale decode,
+        # on the GPU (decode, adjustments and nvJPEG encode) when configured
+        # and the file is a JPEG nvJPEG can handle
+        rendered = None
+        if app.config['USE_GPU'] and gpu_backend.supports(original_filepath):
+            rendered = gpu_backend.render_preview(
+                original_filepath, PREVIEW_MAX, **adjustments
+            )
         
-        # Return preview
-        preview = image_to_base64(img)
+        if rendered is not None:
+            preview_bytes, full_size = rendered
+            # supports() only lets JPEGs through
+            original_format = 'JPEG'
+            preview = encoded_to_base64(preview_bytes, 'image/jpeg')
+        else:
+            arr, full_size, original_format = image_cache.load_preview(original_filepath)
+            preview = image_to_base64(render_adjustments(arr, **adjustments))
+        
+        # Don't re-render the working copy at full resolution on every slider
+        # tick; record the adjustments and apply them when the file is needed
+        write_pending_adjustments(filename, adjustments)
+        
+        # Get updated info (full-resolution dimensions, from the cache entry).
+        # The adjusted file isn't written until it is needed, so its size isn't
+        # known yet and is left out rather than reporting the original's.
+        img_info = {
+            'width': full_size[0],
+            'height': full_size[1],
+            'format': original_format
+        }
         
         return jsonify({
             'success': True,
@@ -194,14 +493,16 @@ def brightness():
         if not os.path.exists(filepath):
             return jsonify({'error': 'File not found'}), 404
         
+        apply_pending_adjustments(filename)
+        
         # Adjust brightness
-        adjusted_img = adjust_brightness(filepath, brightness_factor)
+        adjusted_img = adjust_brightness(get_working_path(filename), brightness_factor)
         
-        # Get updated info
-        img_info = get_image_info(adjusted_img)
+        # Save adjusted image (replace the intermediate copy)
+        size_bytes = save_working_copy(adjusted_img, filename)
         
-        # Save adjusted image (overwrite)
-        save_image(adjusted_img, filepath)
+        # Get updated info
+        img_info = get_image_info(adjusted_img, size_bytes=size_bytes, format='JPEG')
         
         # Return preview
         preview = image_to_base64(adjusted_img)
@@ -245,16 +546,20 @@ def compress():
         if not os.path.exists(filepath):
             return jsonify({'error': 'File not found'}), 404
         
-        # Compress image
-        if max_size_kb:
-            compressed_img, actual_quality = compress_image(
-                filepath, 
-                quality=quality, 
-                max_size_kb=int(max_size_kb)
+        apply_pending_adjustments(filename)
+        
+        # Compress in the worker pool so the CPU-bound encodes don't hold the
+        # GIL; this request thread still waits for the result, but the other
+        # threads keep serving requests meanwhile
+        try:
+            encoded_bytes, quality_used, img_info = run_compress_job(
+                get_working_path(filename),
+                quality=quality,
+                max_size_kb=int(max_size_kb) if max_size_kb else None,
+                output_format=output_format
             )
-            quality_used = actual_quality
-        else:
-            compressed_img, quality_used = compress_image(filepath, quality=quality)
+        except BrokenProcessPool:
+            return jsonify({'error': 'Compression failed; the image may be too large to process'}), 500
         
         # Determine new filename based on format
         name_without_ext = filename.rsplit('.', 1)[0]
@@ -267,8 +572,12 @@ def compress():
         new_filename = f"{name_without_ext}.{new_ext}"
         new_filepath = os.path.join(app.config['UPLOAD_FOLDER'], new_filename)
         
-        # Save compressed image with new format
-        save_image(compressed_img, new_filepath, format=output_format, quality=quality_used)
+        # Save compressed image with new format; this is the persistent copy
+        # now, so any intermediate one is superseded
+        save_encoded_image(encoded_bytes, new_filepath)
+        tmp_filepath = get_tmp_path(filename)
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
         
         # If format changed, update the filename and delete old file
         if new_filename != filename:
@@ -279,12 +588,11 @@ def compress():
             new_original = os.path.join(app.config['UPLOAD_FOLDER'], f"original_{new_filename}")
             if os.path.exists(old_original):
                 os.rename(old_original, new_original)
+                image_cache.evict(old_original)
+                gpu_backend.evict(old_original)
         
-        # Get updated info
-        img_info = get_image_info(compressed_img)
-        
-        # Return preview
-        preview = image_to_base64(compressed_img)
+        # Return preview of exactly what was saved
+        preview = encoded_to_base64(encoded_bytes, f"image/{output_format.lower()}")
         
         return jsonify({
             'success': True,
@@ -326,14 +634,16 @@ def crop():
         if not os.path.exists(filepath):
             return jsonify({'error': 'File not found'}), 404
         
+        apply_pending_adjustments(filename)
+        
         # Crop image
-        cropped_img = crop_image(filepath, x, y, width, height)
+        cropped_img = crop_image(get_working_path(filename), x, y, width, height)
         
-        # Save cropped image
-        save_image(cropped_img, filepath)
+        # Save cropped image (replace the intermediate copy)
+        size_bytes = save_working_copy(cropped_img, filename)
         
         # Get updated info
-        img_info = get_image_info(cropped_img)
+        img_info = get_image_info(cropped_img, size_bytes=size_bytes, format='JPEG')
         
         # Return preview
         preview = image_to_base64(cropped_img)
@@ -365,11 +675,19 @@ def download(filename):
         if not os.path.exists(abs_filepath):
             return jsonify({'error': 'File not found'}), 404
         
-        # Send file as download
+        apply_pending_adjustments(filename)
+        promote_working_copy(filename)
+        
+        # Send file as download. Conditional requests get a 304 when the file
+        # hasn't changed since the browser last fetched it.
         return send_file(
             abs_filepath,
             as_attachment=True,
-            download_name=f"edited_{filename}"
+            download_name=f"edited_{filename}",
+            conditional=True,
+            etag=True,
+            last_modified=os.path.getmtime(abs_filepath),
+            max_age=0
         )
     
     except Exception as e:
@@ -379,7 +697,7 @@ def download(filename):
 @app.route('/reset/<filename>', methods=['DELETE'])
 def reset(filename):
     """
-    Delete uploaded file and its original backup
+    Delete uploaded file, its original backup and any intermediate edits
     
     Args:
         filename: Name of file to delete
@@ -393,6 +711,12 @@ def reset(filename):
         
         if os.path.exists(original_filepath):
             os.remove(original_filepath)
+        image_cache.evict(original_filepath)
+        gpu_backend.evict(original_filepath)
+        
+        for tmp_filepath in (get_tmp_path(filename), get_pending_path(filename)):
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
         
         return jsonify({'success': True})
     
@@ -252,11 +252,21 @@ function updatePreview(previewSrc, info) {
 
     if (info) {
         infoDimensions.textContent = `${info.width} × ${info.height}px`;
-        infoSize.textContent = info.size_kb >= 1024
-            ? `${info.size_mb} MB`
-            : `${info.size_kb} KB`;
+        // Real-time previews have no size until the adjustments are saved
+        if (info.size_kb === undefined) {
+            infoSize.textContent = '-';
+        } else {
+            infoSize.textContent = info.size_kb >= 1024
+                ? `${info.size_mb} MB`
+                : `${info.size_kb} KB`;
+        }
         infoFormat.textContent = info.format;
 
+        // Previews may be rendered at reduced resolution, so crop coordinates
+        // are always in the full-resolution size reported by the server
+        actualImageWidth = info.width;
+        actualImageHeight = info.height;
+
         // Update crop max values
         document.getElementById('crop-width').max = info.width;
         document.getElementById('crop-height').max = info.height;
@@ -661,15 +671,10 @@ function handleCropMouseUp() {
 function toggleCropMode() {
     const cropOverlay = document.getElementById('crop-overlay');
     const toggleText = document.getElementById('crop-toggle-text');
-    const imgElement = document.getElementById('image-preview');
 
     cropMode = !cropMode;
 
     if (cropMode) {
-        // Store actual image dimensions
-        actualImageWidth = imgElement.naturalWidth;
-        actualImageHeight = imgElement.naturalHeight;
-
         // Set default crop to full image if not set
         const cropWidth = document.getElementById('crop-width');
         const cropHeight = document.getElementById('crop-height');
@@ -0,0 +1,189 @@
+"""
+GPU Preview Backend
+Optional nvJPEG/CUDA path for real-time adjustments (needs torch + torchvision with CUDA)
+"""
+
+import threading
+from collections import OrderedDict
+
+try:
+    import torch
+    import torch.nn.functional as F
+    from torchvision.io import ImageReadMode, decode_jpeg, encode_jpeg, read_file
+except ImportError:
+    torch = None
+
+# Decoded previews kept in GPU memory
+MAX_ENTRIES = 8
+
+# JPEG quality of the previews nvJPEG encodes
+PREVIEW_QUALITY = 85
+
+# Every JPEG starts with the SOI marker
+JPEG_SOI = b'\xff\xd8'
+
+_entries = OrderedDict()
+# Files nvJPEG failed on (CMYK and other layouts it can't decode)
+_unsupported = set()
+_lock = threading.Lock()
+
+
+def is_available():
+    """
+    Check whether torch/torchvision are installed and a CUDA device is present
+    
+    Returns:
+        bool: True if the GPU backend can be used
+    """
+    return torch is not None and torch.cuda.is_available()
+
+
+def supports(filepath):
+    """
+    Check whether an image can be previewed on the GPU
+    
+    nvJPEG only decodes JPEG; everything else stays on the CPU path. The
+    format is sniffed from the file itself, since the extension can lie (an
+    upload named .jpg, or a PNG that /compress renamed to .jpg).
+    
+    Args:
+        filepath (str): Path to the image file
+    
+    Returns:
+        bool: True if the GPU backend is available and the file is a JPEG
+            nvJPEG hasn't already failed on
+    """
+    if not is_available():
+        return False
+    
+    with _lock:
+        if filepath in _unsupported:
+            return False
+    
+    with open(filepath, 'rb') as f:
+        return f.read(len(JPEG_SOI)) == JPEG_SOI
+
+
+def _load_preview(filepath, max_size):
+    """
+    Get the image as a float CHW tensor on the GPU, decoding it only on a cache miss
+    
+    Args:
+        filepath (str): Path to the JPEG file
+        max_size (int): Longest side of the cached preview
+    
+    Returns:
+        tuple: (torch.Tensor, (width, height)) preview pixels and the full-resolution size
+    """
+    with _lock:
+        entry = _entries.get(filepath)
+        if entry is not None:
+            _entries.move_to_end(filepath)
+            return entry
+    
+    encoded = read_file(filepath)
+    img = decode_jpeg(encoded, mode=ImageReadMode.RGB, device='cuda').float()
+    height, width = img.shape[1:]
+    
+    ratio = max_size / max(width, height)
+    if ratio < 1:
+        size = (max(1, round(height * ratio)), max(1, round(width * ratio)))
+        img = F.interpolate(img[None], size=size, mode='area')[0]
+    
+    entry = (img, (width, height))
+    with _lock:
+        _entries[filepath] = entry
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+    
+    return entry
+
+
+def _luma(img):
+    """
+    Compute luma the way Image.convert('L') does (ITU-R 601-2, rounded)
+    
+    Args:
+        img (torch.Tensor): Float RGB pixels, shape (3, height, width)
+    
+    Returns:
+        torch.Tensor: Float luma, shape (height, width)
+    """
+    return (0.299 * img[0] + 0.587 * img[1] + 0.114 * img[2]).round()
+
+
+def render_preview(filepath, max_size, brightness=1.0, contrast=1.0, saturation=1.0,
+                   sharpness=1.0):
+    """
+    Render real-time adjustments on the GPU and encode the preview with nvJPEG
+    
+    Mirrors render_adjustments() in image_processor, step for step, so the
+    GPU and CPU previews look the same. If nvJPEG can't handle the file, it
+    is remembered as unsupported and the caller should render on the CPU.
+    
+    Args:
+        filepath (str): Path to the JPEG file
+        max_size (int): Longest side of the preview
+        brightness (float): Brightness multiplier (1.0=original)
+        contrast (float): Contrast multiplier (1.0=original)
+        saturation (float): Saturation multiplier (1.0=original)
+        sharpness (float): Sharpness multiplier (1.0=original)
+    
+    Returns:
+        tuple: (bytes, (width, height)) JPEG preview and the full-resolution
+            size, or None if the GPU couldn't decode or encode the image
+    """
+    try:
+        return _render_preview(filepath, max_size, brightness, contrast, saturation, sharpness)
+    except RuntimeError:
+        # torch/torchvision report decode, encode and CUDA failures this way
+        with _lock:
+            _entries.pop(filepath, None)
+            _unsupported.add(filepath)
+        return None
+
+
+def _render_preview(filepath, max_size, brightness, contrast, saturation, sharpness):
+    """
+    Render a preview on the GPU; see render_preview()
+    """
+    img, full_size = _load_preview(filepath, max_size)
+    
+    with torch.no_grad():
+        out = img
+        
+        if brightness != 1.0:
+            out = (out * brightness).floor().clamp(0, 255)
+        
+        if contrast != 1.0:
+            mean = torch.floor(_luma(out).mean() + 0.5)
+            out = ((out - mean) * contrast + mean).round().clamp(0, 255)
+        
+        if saturation != 1.0:
+            grey = _luma(out)
+            out = (grey + saturation * (out - grey)).round().clamp(0, 255)
+        
+        if sharpness != 1.0:
+            # ImageFilter.SMOOTH, which ImageEnhance.Sharpness blends against;
+            # like Pillow's filter it leaves the one-pixel border untouched
+            kernel = torch.tensor([[1., 1., 1.], [1., 5., 1.], [1., 1., 1.]], device=out.device) / 13
+            smooth = F.conv2d(out[:, None], kernel[None, None], padding=1)[:, 0].round()
+            smooth[:, 0, :], smooth[:, -1, :] = out[:, 0, :], out[:, -1, :]
+            smooth[:, :, 0], smooth[:, :, -1] = out[:, :, 0], out[:, :, -1]
+            out = (smooth + sharpness * (out - smooth)).round().clamp(0, 255)
+        
+        encoded = encode_jpeg(out.round().clamp(0, 255).to(torch.uint8), quality=PREVIEW_QUALITY)
+    
+    return encoded.cpu().numpy().tobytes(), full_size
+
+
+def evict(filepath):
+    """
+    Drop an image from the GPU cache
+    
+    Args:
+        filepath (str): Path the image was loaded from
+    """
+    with _lock:
+        _entries.pop(filepath, None)
+        _unsupported.discard(filepath)
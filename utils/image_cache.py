@@ -0,0 +1,77 @@
+"""
+Decoded Image Cache
+Keeps decoded originals in memory so real-time adjustments skip disk I/O and decoding
+"""
+
+import threading
+from collections import OrderedDict
+from utils.image_processor import PREVIEW_MAX, load_rgb_array
+
+# Bounds for the cache (whichever is hit first triggers eviction)
+MAX_ENTRIES = 32
+MAX_BYTES = 512 * 1024 * 1024  # 512MB
+
+_entries = OrderedDict()
+_total_bytes = 0
+_lock = threading.Lock()
+
+
+def load_preview(filepath):
+    """
+    Get the decoded preview-resolution pixels of an image, decoding it only on
+    a cache miss
+    
+    Args:
+        filepath (str): Path to the image file
+        
+    Returns:
+        tuple: (numpy.ndarray, (width, height), str) read-only RGB pixels,
+            decoded at roughly PREVIEW_MAX on the longest side, the
+            full-resolution size and the file's format
+    """
+    global _total_bytes
+    
+    with _lock:
+        entry = _entries.get(filepath)
+        if entry is not None:
+            _entries.move_to_end(filepath)
+            return entry
+    
+    # Decode outside the lock so a slow decode doesn't block other images
+    arr, full_size, format = load_rgb_array(filepath, max_size=PREVIEW_MAX)
+    # Entries are shared between requests, so nobody may modify them in place
+    arr.flags.writeable = False
+    entry = (arr, full_size, format)
+    
+    # Images too large for the whole cache are served uncached
+    if arr.nbytes > MAX_BYTES:
+        return entry
+    
+    with _lock:
+        if filepath in _entries:
+            _total_bytes -= _entries.pop(filepath)[0].nbytes
+        _entries[filepath] = entry
+        _total_bytes += arr.nbytes
+        
+        # Evict least recently used entries until both bounds hold
+        while len(_entries) > MAX_ENTRIES or _total_bytes > MAX_BYTES:
+            _, (evicted, *_) = _entries.popitem(last=False)
+            _total_bytes -= evicted.nbytes
+    
+    return entry
+
+
+def evict(filepath):
+    """
+    Drop an image from the cache
+    
+    Args:
+        filepath (str): Path the image was loaded from
+    """
+    global _total_bytes
+    
+    with _lock:
+        entry = _entries.pop(filepath, None)
+        if entry is not None:
+            _total_bytes -= entry[0].nbytes
+
@@ -5,14 +5,36 @@ Handles all image manipulation operations using Pillow (PIL)
 
 import os
 import io
+import math
 import base64
-from PIL import Image, ImageEnhance
+import numpy as np
+import PIL
+from PIL import Image, features
+from PIL.ImageEnhance import Sharpness
 from werkzeug.utils import secure_filename
 
 # Allowed file extensions
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
+ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'webp'})
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 
+# Longest side of real-time previews
+PREVIEW_MAX = 1600
+
+# Lossy WebP settings for browser previews
+PREVIEW_QUALITY = 80
+WEBP_MAX_DIMENSION = 16383
+
+# compress_image models size vs. quality on a mosaic of full-resolution tiles
+# (RATE_MODEL_TILES x RATE_MODEL_TILES tiles of RATE_MODEL_TILE_SIZE pixels),
+# and lets its predictions cost at most this many full-size encodes more than
+# bisecting the quality range would
+RATE_MODEL_TILES = 8
+RATE_MODEL_TILE_SIZE = 32
+SPARE_ENCODES = 1
+
+# ITU-R 601-2 luma weights, the same ones Image.convert('L') uses
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
 
 def allowed_file(filename):
     """
@@ -24,115 +46,507 @@ def allowed_file(filename):
     Returns:
         bool: True if extension is allowed, False otherwise
     """
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, dot, ext = filename.rpartition('.')
+    return bool(dot) and ext.lower() in ALLOWED_EXTENSIONS
+
+
+def get_pillow_build_info():
+    """
+    Describe the Pillow build the interpreter is running
+    
+    Pillow-SIMD publishes its releases as ``<pillow-version>.postN``, which is
+    the only reliable way to tell it apart from stock Pillow at runtime.
+    
+    Returns:
+        dict: Pillow version, whether the SIMD build is active and whether
+            the JPEG codec is linked against libjpeg-turbo
+    """
+    version = PIL.__version__
+    return {
+        'version': version,
+        'simd': '.post' in version,
+        'libjpeg_turbo': bool(features.check_feature('libjpeg_turbo'))
+    }
 
 
-def image_to_base64(image):
+def image_to_base64(image, lossless=False):
     """
     Convert PIL Image to base64 string for frontend preview
     
+    Previews are only displayed in the browser, so they are encoded as lossy
+    WebP, which is several times smaller and faster to encode than PNG.
+    
     Args:
         image (PIL.Image): Image object
+        lossless (bool): Encode as PNG instead, for callers that need exact pixels
         
     Returns:
         str: Base64 encoded image string
     """
     buffered = io.BytesIO()
-    # Save as PNG for lossless preview
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return f"data:image/png;base64,{img_str}"
+    
+    # WebP can't hold images larger than 16383px on a side
+    if lossless or max(image.size) > WEBP_MAX_DIMENSION:
+        image.save(buffered, format="PNG")
+        mime_type = 'image/png'
+    else:
+        if image.mode not in ('RGB', 'RGBA'):
+            has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+        image.save(buffered, format="WEBP", quality=PREVIEW_QUALITY, method=4)
+        mime_type = 'image/webp'
+    
+    # Encode straight from the buffer's memory instead of copying it out first
+    with buffered.getbuffer() as encoded:
+        return encoded_to_base64(encoded, mime_type)
 
 
-def get_image_info(image):
+def encoded_to_base64(encoded_bytes, mime_type):
+    """
+    Wrap already-encoded image data in a base64 data URL
+    
+    Args:
+        encoded_bytes (bytes or memoryview): Encoded image data
+        mime_type (str): MIME type of the data (e.g. image/jpeg)
+        
+    Returns:
+        str: Base64 encoded image string
+    """
+    img_str = base64.b64encode(encoded_bytes).decode('ascii')
+    return f"data:{mime_type};base64,{img_str}"
+
+
+def get_image_info(image, size_bytes=None, format=None):
     """
     Get image metadata (size, dimensions, format)
     
     Args:
         image (PIL.Image): Image object
+        size_bytes (int, optional): Encoded size, when the caller already knows it
+            (e.g. the size of the file it just saved). Without it the size is
+            estimated from the raw pixel data rather than re-encoding the image.
+        format (str, optional): Encoded format, defaults to the image's own format
         
     Returns:
         dict: Image information
     """
-    buffered = io.BytesIO()
-    image.save(buffered, format=image.format or 'PNG')
-    size_bytes = buffered.tell()
+    if size_bytes is None:
+        size_bytes = image.width * image.height * len(image.getbands())
     
     return {
         'width': image.width,
         'height': image.height,
-        'format': image.format or 'PNG',
+        'format': format or image.format or 'PNG',
         'size_kb': round(size_bytes / 1024, 2),
         'size_mb': round(size_bytes / (1024 * 1024), 2)
     }
 
 
-def adjust_brightness(image_path, brightness_factor):
+def flatten_to_rgb(img):
     """
-    Adjust image brightness
+    Composite a transparent image onto a white background
+    
+    Blends in a single NumPy pass with integer arithmetic: uint16 holds
+    channel * alpha without overflow, so no float conversion is needed.
+    
+    Args:
+        img (PIL.Image): Image object
+        
+    Returns:
+        PIL.Image: RGB image for RGBA/LA/P input, otherwise the image unchanged
+    """
+    if img.mode not in ('RGBA', 'LA', 'P'):
+        return img
+    
+    # Skip the blend when nothing is actually transparent: palette images
+    # without a transparent index or alpha palette, or a dummy alpha band
+    # that is all 255
+    if img.mode == 'P' and not img.has_transparency_data:
+        return img.convert('RGB')
+    if img.mode in ('RGBA', 'LA') and img.getextrema()[-1][0] == 255:
+        return img.convert('RGB')
+    
+    # Blend in the image's own bands: RGBA is used as-is and LA blends its
+    # single grey band, rather than materializing an RGBA copy first
+    if img.mode == 'P':
+        img = img.convert('RGBA')
+    arr = np.asarray(img)
+    alpha = arr[..., -1:].astype(np.uint16)
+    # Round to nearest, matching Image.paste with an alpha mask
+    blended = ((arr[..., :-1] * alpha + 255 * (255 - alpha) + 127) // 255).astype(np.uint8)
+    
+    if img.mode == 'LA':
+        return Image.fromarray(blended[..., 0]).convert('RGB')
+    return Image.fromarray(blended)
+
+
+def load_rgb_array(image_path, max_size=None):
+    """
+    Decode an image into an RGB pixel array
     
     Args:
         image_path (str): Path to the image file
+        max_size (int, optional): Longest side the caller needs. JPEGs are then
+            decoded by libjpeg at the smallest 1/2, 1/4 or 1/8 scale that still
+            covers it, skipping most of the IDCT work. Other formats ignore it.
+        
+    Returns:
+        tuple: (numpy.ndarray, (width, height), str) RGB pixels, the
+            full-resolution size and the file's format
+    """
+    img = Image.open(image_path)
+    full_size = img.size
+    format = img.format
+    
+    if max_size and max(img.size) > max_size:
+        # draft() keeps both sides at least as large as requested, so ask for
+        # the aspect-preserving size whose longest side is max_size
+        ratio = max_size / max(img.size)
+        img.draft('RGB', (math.ceil(img.width * ratio), math.ceil(img.height * ratio)))
+    
+    # Convert to RGB if needed
+    img = flatten_to_rgb(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    if max_size:
+        img = _downscale_for_preview(img, max_size)
+    
+    return np.asarray(img), full_size, format
+
+
+def _downscale_for_preview(img, max_size):
+    """
+    Shrink an image so its longest side is at most max_size
+    
+    Reduces by the largest whole factor first, a cheap box filter, and leaves
+    Lanczos only the small remaining step instead of the full-resolution buffer.
+    
+    Args:
+        img (PIL.Image): Image object
+        max_size (int): Longest side of the result
+        
+    Returns:
+        PIL.Image: Downscaled image (the same image if already small enough)
+    """
+    factor = max(img.size) // max_size
+    if factor > 1:
+        img = img.reduce(factor)
+    
+    if max(img.size) > max_size:
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS, reducing_gap=None)
+    
+    return img
+
+
+def adjust_brightness(image, brightness_factor):
+    """
+    Adjust image brightness
+    
+    Args:
+        image (str or numpy.ndarray): Path to the image file, or already decoded
+            uint8 pixels (e.g. from the image cache)
         brightness_factor (float): Brightness multiplier (0.5=darker, 1.0=original, 2.0=brighter)
         
     Returns:
         PIL.Image: Brightness-adjusted image
     """
-    img = Image.open(image_path)
+    if isinstance(image, np.ndarray):
+        arr = image
+    else:
+        img = Image.open(image)
+        
+        # Convert to RGB if necessary (for PNG with transparency)
+        img = flatten_to_rgb(img)
+        if img.mode not in ('L', 'RGB'):
+            img = img.convert('RGB')
+        arr = np.asarray(img)
+    
+    # One table lookup per pixel, no float conversion of the image
+    adjusted = np.take(_brightness_lut(brightness_factor), arr)
+    return Image.fromarray(adjusted)
+
+
+def _brightness_lut(brightness_factor):
+    """
+    Build the lookup table ImageEnhance.Brightness applies
+    
+    Args:
+        brightness_factor (float): Brightness multiplier
+        
+    Returns:
+        numpy.ndarray: 256-entry uint8 table
+    """
+    # Brightness blends with black, i.e. scales every channel. Image.blend
+    # computes in single precision and truncates, so the table does too.
+    scaled = np.arange(256, dtype=np.float32) * np.float32(brightness_factor)
+    return np.clip(np.floor(scaled), 0, 255).astype(np.uint8)
+
+
+def apply_adjustments_fused(arr, brightness=1.0, contrast=1.0, saturation=1.0):
+    """
+    Apply brightness, contrast and saturation in one pass over the pixels
+    
+    Produces the same result as chaining ImageEnhance.Brightness, Contrast and
+    Color (in that order), but brightness and contrast are folded into a single
+    256-entry lookup table and saturation into one luma-preserving blend, so
+    no intermediate images are allocated.
+    
+    Args:
+        arr (numpy.ndarray): RGB pixels, shape (height, width, 3), dtype uint8
+        brightness (float): Brightness multiplier (1.0=original)
+        contrast (float): Contrast multiplier (1.0=original)
+        saturation (float): Saturation multiplier (0.0=greyscale, 1.0=original)
+        
+    Returns:
+        numpy.ndarray: Adjusted RGB pixels, shape (height, width, 3), dtype uint8
+    """
+    out = arr
+    
+    if brightness != 1.0 or contrast != 1.0:
+        lut = _brightness_lut(brightness).astype(np.float64)
+        
+        if contrast != 1.0:
+            # Contrast blends with the mean grey level of the brightened image,
+            # which the per-channel histograms give us without touching pixels twice
+            pixel_count = arr.shape[0] * arr.shape[1]
+            channel_means = [
+                np.bincount(arr[..., c].ravel(), minlength=256) @ lut / pixel_count
+                for c in range(3)
+            ]
+            mean = int(np.dot(LUMA_WEIGHTS, channel_means) + 0.5)
+            lut = np.clip(np.rint((lut - mean) * contrast + mean), 0, 255)
+        
+        out = np.take(lut.astype(np.uint8), out)
+    
+    if saturation != 1.0:
+        # Color blends each pixel with its own luma
+        rgb = out.astype(np.float32)
+        grey = np.rint(rgb @ LUMA_WEIGHTS)[..., np.newaxis]
+        rgb -= grey
+        rgb *= saturation
+        rgb += grey
+        np.clip(rgb, 0, 255, out=rgb)
+        out = np.rint(rgb, out=rgb).astype(np.uint8)
     
-    # Convert to RGB if necessary (for PNG with transparency)
-    if img.mode in ('RGBA', 'LA', 'P'):
-        background = Image.new('RGB', img.size, (255, 255, 255))
-        if img.mode == 'P':
-            img = img.convert('RGBA')
-        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-        img = background
+    return out
+
+
+def render_adjustments(arr, brightness=1.0, contrast=1.0, saturation=1.0, sharpness=1.0):
+    """
+    Apply all real-time adjustments to decoded RGB pixels
+    
+    Args:
+        arr (numpy.ndarray): RGB pixels, shape (height, width, 3), dtype uint8
+        brightness (float): Brightness multiplier (1.0=original)
+        contrast (float): Contrast multiplier (1.0=original)
+        saturation (float): Saturation multiplier (1.0=original)
+        sharpness (float): Sharpness multiplier (1.0=original)
+        
+    Returns:
+        PIL.Image: Adjusted image
+    """
+    # Brightness, contrast and saturation in one fused pass
+    if brightness != 1.0 or contrast != 1.0 or saturation != 1.0:
+        arr = apply_adjustments_fused(arr, brightness, contrast, saturation)
+    img = Image.fromarray(arr)
     
-    enhancer = ImageEnhance.Brightness(img)
-    adjusted_img = enhancer.enhance(brightness_factor)
+    # Sharpness is a 3x3 convolution, so it stays a separate Pillow pass
+    if sharpness != 1.0:
+        img = Sharpness(img).enhance(sharpness)
     
-    return adjusted_img
+    return img
 
 
-def compress_image(image_path, quality=85, max_size_kb=None):
+def compress_image(image_path, quality=85, max_size_kb=None, output_format='JPEG'):
     """
     Compress image by reducing quality
     
+    Takes a path and returns plain bytes so it can run in a worker process
+    without pickling images across the process boundary.
+    
     Args:
         image_path (str): Path to the image file
         quality (int): JPEG quality (1-100, lower = more compression)
         max_size_kb (int, optional): Target maximum file size in KB
+        output_format (str): Format to encode the result in (JPEG, PNG, WEBP)
         
     Returns:
-        tuple: (PIL.Image, actual_quality_used)
+        tuple: (encoded_bytes, actual_quality_used, info) with the image encoded
+            in output_format and its get_image_info() metadata
     """
     img = Image.open(image_path)
     
     # Convert RGBA to RGB for JPEG compression
-    if img.mode in ('RGBA', 'LA', 'P'):
-        background = Image.new('RGB', img.size, (255, 255, 255))
-        if img.mode == 'P':
-            img = img.convert('RGBA')
-        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-        img = background
-    
-    # If max_size_kb is specified, iteratively reduce quality
+    img = flatten_to_rgb(img)
+    
+    quality_used, encoded_bytes = _search_quality(img, quality, max_size_kb)
+    
+    # The quality search produces JPEG; any other format is encoded once more
+    if output_format != 'JPEG' or encoded_bytes is None:
+        buffered = io.BytesIO()
+        img.save(buffered, **_get_save_kwargs(output_format, quality_used))
+        encoded_bytes = buffered.getvalue()
+    
+    info = get_image_info(img, size_bytes=len(encoded_bytes), format=output_format)
+    return encoded_bytes, quality_used, info
+
+
+def _search_quality(img, quality, max_size_kb):
+    """
+    Find the highest JPEG quality that keeps the image under a target size
+    
+    Args:
+        img (PIL.Image): RGB image
+        quality (int): Highest quality to consider
+        max_size_kb (int, optional): Target maximum file size in KB
+        
+    Returns:
+        tuple: (quality, encoded_bytes) where encoded_bytes is the JPEG at that
+            quality, or None if no target size was given or nothing fits
+    """
+    # If max_size_kb is specified, search for the highest quality that fits
     if max_size_kb:
-        current_quality = quality
-        while current_quality > 10:
-            buffered = io.BytesIO()
-            img.save(buffered, format='JPEG', quality=current_quality, optimize=True)
-            size_kb = buffered.tell() / 1024
+        max_size_bytes = max_size_kb * 1024
+        # Size the buffer once for a typical encode, so the attempts below
+        # overwrite it in place instead of regrowing it by reallocation
+        buffered = io.BytesIO()
+        buffered.seek(max(64 * 1024, img.width * img.height * 3 // 20) - 1)
+        buffered.write(b'\0')
+        
+        # Often the requested quality is already small enough
+        full_size = _encode_jpeg(img, quality, buffered)
+        if full_size <= max_size_bytes or quality <= 10:
+            return quality, _read_encoded(buffered, full_size)
+        
+        # Model size vs. quality on a small sample of the image, where encodes
+        # are nearly free, scaled by the full/sample size ratio measured at the
+        # full encodes on either side of each prediction. The sample is full-
+        # resolution tiles rather than a thumbnail: downscaling removes the
+        # fine detail the full image pays for at high quality, which made the
+        # ratio drift several-fold across the quality range.
+        sample = _rate_model_sample(img)
+        sample_buffered = io.BytesIO()
+        sample_sizes = {}
+        size_ratios = {}
+        
+        def sample_size(q):
+            if q not in sample_sizes:
+                sample_sizes[q] = _encode_jpeg(sample, q, sample_buffered)
+            return sample_sizes[q]
+        
+        def size_ratio(q):
+            # There is always a full encode above q, the one at `quality`
+            above = min(k for k in size_ratios if k >= q)
+            below = max((k for k in size_ratios if k <= q), default=above)
+            if below == above:
+                return size_ratios[above]
+            weight = (q - below) / (above - below)
+            return size_ratios[below] + weight * (size_ratios[above] - size_ratios[below])
+        
+        def predict(lo, hi):
+            # Highest quality in [lo, hi] the model says fits
+            predicted = lo
+            while lo <= hi:
+                mid = (lo + hi) // 2
+                if sample_size(mid) * size_ratio(mid) <= max_size_bytes:
+                    predicted = mid
+                    lo = mid + 1
+                else:
+                    hi = mid - 1
+            return predicted
+        
+        # File size grows monotonically with quality, so narrowing [lo, hi]
+        # around each full encode keeps the search exact. Bisection needs
+        # count.bit_length() encodes for count qualities; each probe is kept
+        # far enough inside the range that whatever it leaves can still be
+        # bisected within the remaining budget, so bad predictions cost at
+        # most SPARE_ENCODES extra encodes and good ones end the search early.
+        lo, hi = 10, quality - 1
+        best_quality = lo
+        best_encoded = None
+        size_ratios[quality] = full_size / sample_size(quality)
+        budget = (hi - lo + 1).bit_length() + SPARE_ENCODES
+        while lo <= hi:
+            count = hi - lo + 1
+            margin = max(0, count - (1 << (budget - 1)))
+            probe = min(max(predict(lo, hi), lo + margin), hi - margin)
+            budget -= 1
             
-            if size_kb <= max_size_kb:
-                break
+            full_size = _encode_jpeg(img, probe, buffered)
+            size_ratios[probe] = full_size / sample_size(probe)
             
-            # Reduce quality by 5% each iteration
-            current_quality -= 5
+            if full_size <= max_size_bytes:
+                best_quality = probe
+                best_encoded = _read_encoded(buffered, full_size)
+                lo = probe + 1
+            else:
+                hi = probe - 1
         
-        return img, current_quality
+        return best_quality, best_encoded
     
-    return img, quality
+    return quality, None
+
+
+def _rate_model_sample(img):
+    """
+    Build the image _search_quality models file size on
+    
+    Args:
+        img (PIL.Image): RGB image
+        
+    Returns:
+        PIL.Image: Evenly spaced full-resolution tiles pasted into a grid, or
+            the image itself if it is no larger than the grid
+    """
+    side = RATE_MODEL_TILES * RATE_MODEL_TILE_SIZE
+    if img.width <= side and img.height <= side:
+        return img
+    
+    # Tile origins are kept on the 16-pixel grid of JPEG's (subsampled) blocks,
+    # so each tile encodes like the same pixels do in the full image
+    tile = min(RATE_MODEL_TILE_SIZE, img.width, img.height)
+    sample = Image.new('RGB', (RATE_MODEL_TILES * tile, RATE_MODEL_TILES * tile))
+    for row in range(RATE_MODEL_TILES):
+        y = (img.height - tile) * row // (RATE_MODEL_TILES - 1) // 16 * 16
+        for col in range(RATE_MODEL_TILES):
+            x = (img.width - tile) * col // (RATE_MODEL_TILES - 1) // 16 * 16
+            sample.paste(img.crop((x, y, x + tile, y + tile)), (col * tile, row * tile))
+    return sample
+
+
+def _encode_jpeg(img, quality, buffered):
+    """
+    Encode image as JPEG into a reusable buffer
+    
+    Args:
+        img (PIL.Image): Image object
+        quality (int): JPEG quality
+        buffered (io.BytesIO): Buffer to overwrite with the encoded data
+        
+    Returns:
+        int: Encoded size in bytes; anything in the buffer past it is stale
+    """
+    # No truncate(): shrinking a BytesIO frees its memory, and the next
+    # attempt would have to grow it back chunk by chunk
+    buffered.seek(0)
+    img.save(buffered, format='JPEG', quality=quality, optimize=True)
+    return buffered.tell()
+
+
+def _read_encoded(buffered, size):
+    """
+    Copy the current encode out of a buffer filled by _encode_jpeg
+    
+    Args:
+        buffered (io.BytesIO): Buffer passed to _encode_jpeg
+        size (int): Size _encode_jpeg returned
+        
+    Returns:
+        bytes: Encoded data
+    """
+    with buffered.getbuffer() as view:
+        return bytes(view[:size])
 
 
 def crop_image(image_path, x, y, width, height):
@@ -167,24 +581,33 @@ def crop_image(image_path, x, y, width, height):
     return cropped_img
 
 
-def save_image(image, filepath, format='JPEG', quality=95):
+def save_encoded_image(encoded_bytes, filepath):
     """
-    Save PIL Image to file
+    Write an already-encoded image to file without re-encoding it
     
     Args:
-        image (PIL.Image): Image object to save
+        encoded_bytes (bytes): Encoded image data
         filepath (str): Destination file path
+    """
+    # Replace rather than overwrite, same as save_image
+    if os.path.exists(filepath):
+        os.unlink(filepath)
+    
+    with open(filepath, 'wb') as f:
+        f.write(encoded_bytes)
+
+
+def _get_save_kwargs(format, quality):
+    """
+    Build Pillow save() arguments for a format
+    
+    Args:
         format (str): Image format (JPEG, PNG, WEBP)
         quality (int): Quality for lossy formats
+        
+    Returns:
+        dict: Keyword arguments for PIL.Image.save
     """
-    # Ensure RGB mode for JPEG
-    if format.upper() == 'JPEG' and image.mode in ('RGBA', 'LA', 'P'):
-        background = Image.new('RGB', image.size, (255, 255, 255))
-        if image.mode == 'P':
-            image = image.convert('RGBA')
-        background.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
-        image = background
-    
     save_kwargs = {'format': format}
     
     if format.upper() in ('JPEG', 'WEBP'):
@@ -193,4 +616,29 @@ def save_image(image, filepath, format='JPEG', quality=95):
     elif format.upper() == 'PNG':
         save_kwargs['optimize'] = True
     
+    return save_kwargs
+
+
+def save_image(image, filepath, format='JPEG', quality=95):
+    """
+    Save PIL Image to file
+    
+    Args:
+        image (PIL.Image): Image object to save
+        filepath (str): Destination file path
+        format (str): Image format (JPEG, PNG, WEBP)
+        quality (int): Quality for lossy formats
+    """
+    # Ensure RGB mode for JPEG
+    if format.upper() == 'JPEG':
+        image = flatten_to_rgb(image)
+    
+    save_kwargs = _get_save_kwargs(format, quality)
+    
+    # Replace rather than overwrite: the working copy may still be a hardlink
+    # to the original upload, and writing through it would modify both
+    image.load()
+    if os.path.exists(filepath):
+        os.unlink(filepath)
+    
     image.save(filepath, **save_kwargs)